@@ -0,0 +1,18 @@
+# gunicorn.conf.py
+# Thread count follows the admission control settings: one thread per
+# running slot, queued critical request and coalesced follower
+# (see utils/admission_ops.py)
+import os
+import sys
+
+# the config is loaded before gunicorn adds the app directory to sys.path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from utils.admission_ops import WORKER_THREADS
+
+bind = ":8080"
+threads = WORKER_THREADS
+# accept no more connections than there are threads: excess requests stay
+# with Cloud Run (which routes them to another instance) instead of
+# waiting unseen in the gthread worker's unbounded queue
+worker_connections = WORKER_THREADS
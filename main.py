@@ -1,5 +1,7 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 from google.cloud import firestore
+import hmac
+import os
 from flask_cors import CORS
 
 # Firestore business logic functions
@@ -13,19 +15,46 @@ from utils.firestore_ops import (
 # GCS Signed URL utility
 from utils.storage_ops import generate_signed_url
 
+# Outbox drainer for domain events
+from utils.outbox_ops import drain_outbox, start_outbox_drainer
+
+# Single-flight for hot read endpoints
+from utils.coalesce_ops import coalesce, coalesce_stats, is_shared
+
+# Per-route admission control / load shedding
+from utils.admission_ops import acquire, release, acquire_follower, release_follower, admission_stats
+
+# Bulk analytics export
+from utils.export_ops import (
+    start_export_run,
+    get_export_run,
+    validate_export_args,
+    EXPORT_BUCKET,
+    DEFAULT_PARTITIONS,
+)
+
 app = Flask(__name__)
 
 CORS(
     app,
     resources={r"/api/*": {"origins": "*"}},
     methods=["GET", "POST", "OPTIONS"],
-    allow_headers=["Content-Type", "Authorization"]
+    allow_headers=["Content-Type", "Authorization", "Idempotency-Key"]
 )
 
 
 db = firestore.Client()
 REQUEST_COLL = "requests"
 
+# Shared secret for operational endpoints (export, outbox drain), sent as X-Ops-Token
+OPS_TOKEN = os.getenv("OPS_TOKEN")
+
+# Publish outbox events in the background unless disabled (e.g. when a
+# Cloud Scheduler job calls /api/outbox/drain instead). The thread needs
+# CPU between requests, hence --no-cpu-throttling in deploy.yml.
+if os.getenv("OUTBOX_DRAINER", "1") == "1":
+    start_outbox_drainer()
+
 # ---------------------------------------------------------
 # Helper to convert Firestore document to dict
 # ---------------------------------------------------------
@@ -35,6 +64,76 @@ def request_to_dict(doc):
     return d
 
 
+# ---------------------------------------------------------
+# Helper to share one Firestore read among identical concurrent calls
+# ---------------------------------------------------------
+# endpoints that serve their response through coalesced_json
+COALESCED_ROUTES = {"api_get_purchase_orders", "api_incoming_requests_with_workorders"}
+
+
+def coalesce_key():
+    return request.path + "?" + "&".join(
+        f"{k}={v}" for k, v in sorted(request.args.items(multi=True))
+    )
+
+
+def coalesced_json(fetch):
+    """
+    Run fetch() at most once per in-flight (route + query params) and
+    return its JSON-serialized result to every waiting caller.
+    """
+    body = coalesce(coalesce_key(), lambda: app.json.dumps(fetch()))
+    return Response(body, status=200, mimetype="application/json")
+
+
+# ---------------------------------------------------------
+# Admission control — shed load before it ties up a worker thread
+# ---------------------------------------------------------
+@app.before_request
+def admit_request():
+    if request.method == "OPTIONS":
+        return None
+
+    # callers that will just join an in-flight identical read use the
+    # follower pool, or else skip the route's own cap (the fetch is already
+    # running); if that fetch ends before they join, they run it themselves
+    shared = request.endpoint in COALESCED_ROUTES and is_shared(coalesce_key())
+
+    if shared and acquire_follower(request.endpoint):
+        g.follower = True
+        return None
+
+    rejected = acquire(request.endpoint, shared)
+    if rejected:
+        status, retry_after = rejected
+        resp = jsonify({"error": "Server busy, retry later"})
+        resp.headers["Retry-After"] = str(retry_after)
+        return resp, status
+
+    g.admitted = (request.endpoint, shared)
+    return None
+
+
+@app.teardown_request
+def release_request(exc):
+    if g.pop("follower", False):
+        release_follower()
+
+    admitted = g.pop("admitted", None)
+    if admitted is not None:
+        release(*admitted)
+
+
+# ---------------------------------------------------------
+# Helper to guard operational endpoints
+# ---------------------------------------------------------
+def ops_token_valid():
+    # endpoints stay closed until OPS_TOKEN is configured
+    # compare bytes: compare_digest rejects non-ASCII str with a TypeError
+    token = request.headers.get("X-Ops-Token", "").encode("utf-8")
+    return bool(OPS_TOKEN) and hmac.compare_digest(token, OPS_TOKEN.encode("utf-8"))
+
+
 # ---------------------------------------------------------
 # Test Route
 # ---------------------------------------------------------
@@ -49,7 +148,9 @@ def home():
 @app.post("/api/requests")
 def api_create_request():
     data = request.json
-    response = create_request(data)
+    response = create_request(data, request.headers.get("Idempotency-Key"))
+    if response.get("idempotency_conflict"):
+        return jsonify(response), 422
     return jsonify(response), 200
 
 
@@ -115,14 +216,16 @@ def api_submit_work_order(wo_id):
 @app.post("/api/purchase-orders")
 def api_po_create():
     data = request.json
-    response = create_purchase_order(data)
+    response = create_purchase_order(data, request.headers.get("Idempotency-Key"))
+    if response.get("idempotency_conflict"):
+        return jsonify(response), 422
     return jsonify(response), 200
 # ---------------------------------------------------------
 # 5B. PURCHASE ORDER — List All POs
 # ---------------------------------------------------------
 @app.get("/api/purchase-orders")
 def api_get_purchase_orders():
-    try:
+    def fetch():
         docs = db.collection("purchase_orders").order_by(
             "created_at", direction=firestore.Query.DESCENDING
         ).stream()
@@ -131,7 +234,10 @@ def api_get_purchase_orders():
         for d in docs:
             results.append(d.to_dict())
 
-        return jsonify({"purchase_orders": results}), 200
+        return {"purchase_orders": results}
+
+    try:
+        return coalesced_json(fetch)
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -257,36 +363,39 @@ def api_get_work_orders():
 
 @app.get("/api/requests/incoming-with-workorders")
 def api_incoming_requests_with_workorders():
-    statuses = ["CRT", "PENDING", "IN-PROGRESS","INSPECTION_COMPLETED"]
+    def fetch():
+        statuses = ["CRT", "PENDING", "IN-PROGRESS","INSPECTION_COMPLETED"]
 
-    req_docs = (
-        db.collection("requests")
-        .where("status", "in", statuses)
-        .order_by("created_at", direction=firestore.Query.DESCENDING)
-        .stream()
-    )
+        req_docs = (
+            db.collection("requests")
+            .where("status", "in", statuses)
+            .order_by("created_at", direction=firestore.Query.DESCENDING)
+            .stream()
+        )
 
-    results = []
+        results = []
 
-    for req in req_docs:
-        req_data = req.to_dict()
-        request_id = req_data["requestId"]
+        for req in req_docs:
+            req_data = req.to_dict()
+            request_id = req_data["requestId"]
 
-        # Fetch work orders for this request
-        wo_docs = (
-            db.collection("work_orders")
-            .where("requestId", "==", request_id)
-            .stream()
-        )
+            # Fetch work orders for this request
+            wo_docs = (
+                db.collection("work_orders")
+                .where("requestId", "==", request_id)
+                .stream()
+            )
 
-        work_orders = [wo.to_dict() for wo in wo_docs]
+            work_orders = [wo.to_dict() for wo in wo_docs]
 
-        results.append({
-            **req_data,
-            "work_orders": work_orders
-        })
+            results.append({
+                **req_data,
+                "work_orders": work_orders
+            })
 
-    return jsonify({"incoming_requests": results}), 200
+        return {"incoming_requests": results}
+
+    return coalesced_json(fetch)
 
 @app.get("/api/customer/request-status")
 def api_customer_request_status():
@@ -327,6 +436,96 @@ def api_customer_request_status():
     }), 200
 
 
+# ---------------------------------------------------------
+# 11. ANALYTICS — Bulk Export to GCS
+# ---------------------------------------------------------
+@app.post("/api/export")
+def api_export():
+    """
+    Starts a background export and returns its runId straight away;
+    poll GET /api/export/<runId> for the result. Large backfills should
+    use `python -m utils.export_ops` instead.
+
+    Expected JSON (all optional):
+    {
+      "collections": ["requests", "work_orders", "purchase_orders"],
+      "format": "ndjson" or "parquet",
+      "partitions": 8,
+      "incremental": true
+    }
+    """
+    if not ops_token_valid():
+        return jsonify({"error": "Forbidden"}), 403
+
+    if not EXPORT_BUCKET:
+        return jsonify({"error": "EXPORT_BUCKET is not configured"}), 400
+
+    data = request.get_json(silent=True) or {}
+    collections = data.get("collections")
+    fmt = data.get("format", "ndjson")
+    partitions = data.get("partitions", DEFAULT_PARTITIONS)
+    incremental = data.get("incremental", False)
+
+    if collections is not None and not isinstance(collections, list):
+        return jsonify({"error": "collections must be a list"}), 400
+
+    if not isinstance(incremental, bool):
+        return jsonify({"error": "incremental must be true or false"}), 400
+
+    error = validate_export_args(collections, fmt, partitions)
+    if error:
+        return jsonify({"error": error}), 400
+
+    # files are streamed straight to GCS, nothing is staged in the in-memory /tmp
+    try:
+        run_id = start_export_run(f"gs://{EXPORT_BUCKET}/exports", collections, fmt, partitions, incremental)
+    except Exception as e:
+        print("EXPORT START ERROR:", e)
+        return jsonify({"error": str(e)}), 500
+
+    if run_id is None:
+        return jsonify({"error": "An export is already running"}), 409
+
+    return jsonify({"runId": run_id, "status": "RUNNING"}), 202
+
+
+@app.get("/api/export/<run_id>")
+def api_export_status(run_id):
+    if not ops_token_valid():
+        return jsonify({"error": "Forbidden"}), 403
+
+    run = get_export_run(run_id)
+    if run is None:
+        return jsonify({"error": "Export run not found"}), 404
+
+    return jsonify(run), 200
+
+
+# ---------------------------------------------------------
+# 12. EVENTS — Drain Outbox to Pub/Sub
+# ---------------------------------------------------------
+@app.post("/api/outbox/drain")
+def api_drain_outbox():
+    if not ops_token_valid():
+        return jsonify({"error": "Forbidden"}), 403
+
+    result = drain_outbox()
+    if "error" in result:
+        return jsonify(result), 500
+    return jsonify(result), 200
+
+
+# ---------------------------------------------------------
+# 13. OPS — In-process Metrics
+# ---------------------------------------------------------
+@app.get("/api/metrics")
+def api_metrics():
+    return jsonify({
+        "coalescing": coalesce_stats(),
+        "admission": admission_stats(),
+    }), 200
+
+
 # ---------------------------------------------------------
 # Run Local Server
 # ---------------------------------------------------------
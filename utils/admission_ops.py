@@ -0,0 +1,202 @@
+# utils/admission_ops.py
+"""
+Per-route admission control and load shedding.
+
+Every routed request takes a slot from the worker's shared capacity
+(ADMISSION_CAPACITY). Routes belong to a priority class:
+
+  critical - writes and upload URLs; may use the whole capacity, including
+             the ADMISSION_CRITICAL_RESERVE slots nobody else can take
+  normal   - everything not listed below
+  bulk     - slow listing/export routes, additionally capped per route
+
+Only critical requests wait for a slot, in a queue of at most
+ADMISSION_CRITICAL_QUEUE. Normal and bulk requests are shed immediately,
+since a waiting request pins a gunicorn thread: 429 when the route's own
+limit was the blocker, 503 when the shared capacity was, both with
+Retry-After.
+
+Requests that will only join an in-flight coalesced read (see
+utils/coalesce_ops.py) first try a separate pool of
+ADMISSION_FOLLOWER_SLOTS. They do no Firestore work of their own, so
+they should not compete with real work for the non-critical slots. They
+still pin a thread while they wait, which is why the pool is bounded and
+has threads of its own. When it is full they fall back to the normal
+non-critical path.
+
+gunicorn.conf.py sizes the thread pool to capacity plus the critical queue
+plus the follower pool, so neither queued critical requests nor followers
+eat into running slots.
+"""
+import os
+import threading
+import time
+
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "1") == "1"
+CAPACITY = int(os.getenv("ADMISSION_CAPACITY", "8"))
+CRITICAL_RESERVE = int(os.getenv("ADMISSION_CRITICAL_RESERVE", "2"))
+CRITICAL_QUEUE = int(os.getenv("ADMISSION_CRITICAL_QUEUE", "4"))
+CRITICAL_MAX_WAIT = float(os.getenv("ADMISSION_CRITICAL_MAX_WAIT", "5"))
+FOLLOWER_SLOTS = int(os.getenv("ADMISSION_FOLLOWER_SLOTS", "16"))
+
+# gunicorn threads per worker: running slots, queued critical requests
+# and coalesced followers
+WORKER_THREADS = CAPACITY + CRITICAL_QUEUE + FOLLOWER_SLOTS
+
+# class -> Retry-After seconds sent when a request is shed
+RETRY_AFTER = {"critical": 1, "normal": 2, "bulk": 5}
+
+# Flask endpoint name -> (class, per-route concurrency limit or None)
+ROUTE_POLICIES = {
+    "api_create_request": ("critical", None),
+    "api_po_create": ("critical", None),
+    "api_signed_url": ("critical", None),
+    "api_inspect_work_order": ("critical", None),
+    "api_submit_work_order": ("critical", None),
+    "api_ordered_requests": ("bulk", 2),
+    "api_completed_requests": ("bulk", 2),
+    "api_incoming_requests_with_workorders": ("bulk", 3),
+    "api_get_purchase_orders": ("bulk", 3),
+    "api_export": ("bulk", 1),
+}
+
+# never queued or shed, so health checks and metrics stay reachable
+EXEMPT_ROUTES = {"home", "api_metrics", "static"}
+
+_cond = threading.Condition()
+_in_use = 0
+_in_use_by_route = {}
+_critical_queued = 0
+_followers = 0
+_stats = {}  # route -> counters
+
+
+def _exempt(route) -> bool:
+    return not ADMISSION_ENABLED or route is None or route in EXEMPT_ROUTES
+
+
+def _route_stats(route: str) -> dict:
+    if route not in _stats:
+        _stats[route] = {"admitted": 0, "shared": 0, "queued": 0, "shed_429": 0, "shed_503": 0}
+    return _stats[route]
+
+
+def _blocker(route: str, cls: str, limit):
+    """
+    Return None if the request may run now, otherwise what is blocking it:
+    "route" (its own limit) or "capacity" (shared slots).
+    """
+    if limit is not None and _in_use_by_route.get(route, 0) >= limit:
+        return "route"
+    if cls == "critical":
+        return None if _in_use < CAPACITY else "capacity"
+    # queued critical requests go first
+    if _critical_queued > 0:
+        return "capacity"
+    return None if _in_use < CAPACITY - CRITICAL_RESERVE else "capacity"
+
+
+def acquire(route: str, shared: bool = False):
+    """
+    Try to admit a request for the Flask endpoint `route`.
+    `shared` marks a request that will join an in-flight coalesced fetch;
+    it neither counts against nor is blocked by the route's own limit, but
+    it still takes a shared slot since it occupies a thread.
+    Returns None when admitted (call release(route) afterwards), otherwise
+    (status_code, retry_after_seconds) for the rejection.
+    """
+    global _in_use, _critical_queued
+
+    if _exempt(route):
+        return None
+
+    cls, limit = ROUTE_POLICIES.get(route, ("normal", None))
+    if shared:
+        limit = None
+
+    with _cond:
+        stats = _route_stats(route)
+        blocker = _blocker(route, cls, limit)
+
+        if blocker is not None:
+            if cls != "critical" or _critical_queued >= CRITICAL_QUEUE:
+                return _shed(stats, blocker, cls)
+
+            stats["queued"] += 1
+            _critical_queued += 1
+            deadline = time.monotonic() + CRITICAL_MAX_WAIT
+            try:
+                while blocker is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return _shed(stats, blocker, cls)
+                    _cond.wait(remaining)
+                    blocker = _blocker(route, cls, limit)
+            finally:
+                _critical_queued -= 1
+
+        _in_use += 1
+        if shared:
+            stats["shared"] += 1
+        else:
+            _in_use_by_route[route] = _in_use_by_route.get(route, 0) + 1
+            stats["admitted"] += 1
+        return None
+
+
+def acquire_follower(route: str) -> bool:
+    """
+    Admit a request that will join an in-flight coalesced read into the
+    follower pool. Returns False when the pool is full; the caller then
+    goes through acquire(route, shared=True). Release with release_follower().
+    """
+    global _followers
+
+    if _exempt(route):
+        return False
+
+    with _cond:
+        if _followers >= FOLLOWER_SLOTS:
+            return False
+        _followers += 1
+        _route_stats(route)["shared"] += 1
+        return True
+
+
+def release_follower() -> None:
+    global _followers
+
+    with _cond:
+        _followers -= 1
+
+
+def _shed(stats: dict, blocker: str, cls: str):
+    status = 429 if blocker == "route" else 503
+    stats[f"shed_{status}"] += 1
+    return status, RETRY_AFTER[cls]
+
+
+def release(route: str, shared: bool = False) -> None:
+    global _in_use
+
+    if _exempt(route):
+        return
+
+    with _cond:
+        _in_use -= 1
+        if not shared:
+            _in_use_by_route[route] -= 1
+        _cond.notify_all()
+
+
+def admission_stats() -> dict:
+    with _cond:
+        return {
+            "capacity": CAPACITY,
+            "critical_reserve": CRITICAL_RESERVE,
+            "in_use": _in_use,
+            "critical_queued": _critical_queued,
+            "followers": _followers,
+            "follower_slots": FOLLOWER_SLOTS,
+            "routes": {r: dict(s) for r, s in _stats.items()},
+        }
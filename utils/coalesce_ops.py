@@ -0,0 +1,107 @@
+# utils/coalesce_ops.py
+"""
+In-process request coalescing (single-flight) for read endpoints.
+
+Concurrent calls with the same key share one execution of the fetch
+function and its serialized result instead of each running the same
+Firestore scan. A finished result is also reused for
+COALESCE_REUSE_WINDOW_MS (default 1000 ms, 0 disables it).
+
+Trade-off: within the window callers may get data up to that old, in
+exchange for dashboards that poll in bursts costing one scan per window
+instead of one per request. Followers that wait on an in-flight fetch
+still pin a thread each; utils/admission_ops.py gives them their own
+bounded pool so they neither crowd out real work nor get shed while
+their result is already being fetched.
+
+Only threads of the same process share results, so this pays off with
+gunicorn's threaded workers.
+"""
+import os
+import threading
+import time
+
+REUSE_WINDOW = float(os.getenv("COALESCE_REUSE_WINDOW_MS", "1000")) / 1000.0
+
+_lock = threading.Lock()
+_inflight = {}  # key -> _Call currently running
+_recent = {}    # key -> (finished_at, result), only used with a reuse window
+_stats = {"requests": 0, "fetches": 0, "shared": 0, "reused": 0}
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def coalesce(key: str, fn):
+    """
+    Return fn(), sharing a single in-flight call among concurrent callers
+    with the same key. Errors are re-raised in every caller.
+    """
+    with _lock:
+        _stats["requests"] += 1
+
+        if REUSE_WINDOW > 0:
+            hit = _recent.get(key)
+            if hit and time.monotonic() - hit[0] < REUSE_WINDOW:
+                _stats["reused"] += 1
+                return hit[1]
+
+        call = _inflight.get(key)
+        leader = call is None
+        if leader:
+            call = _Call()
+            _inflight[key] = call
+            _stats["fetches"] += 1
+        else:
+            _stats["shared"] += 1
+
+    if not leader:
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    try:
+        call.result = fn()
+    except Exception as e:
+        call.error = e
+        raise
+    finally:
+        with _lock:
+            _inflight.pop(key, None)
+            if REUSE_WINDOW > 0 and call.error is None:
+                now = time.monotonic()
+                for k in [k for k, (ts, _) in _recent.items() if now - ts >= REUSE_WINDOW]:
+                    del _recent[k]
+                _recent[key] = (now, call.result)
+        call.done.set()
+
+    return call.result
+
+
+def is_shared(key: str) -> bool:
+    """
+    True if a call for `key` right now would join an in-flight fetch or
+    reuse a recent result rather than run its own fetch.
+    """
+    with _lock:
+        if key in _inflight:
+            return True
+        hit = _recent.get(key)
+        return bool(REUSE_WINDOW > 0 and hit and time.monotonic() - hit[0] < REUSE_WINDOW)
+
+
+def coalesce_stats() -> dict:
+    """
+    Counters since process start. collapse_ratio = requests served per
+    Firestore fetch actually executed.
+    """
+    with _lock:
+        stats = dict(_stats)
+    stats["in_flight"] = len(_inflight)
+    stats["collapse_ratio"] = round(stats["requests"] / stats["fetches"], 2) if stats["fetches"] else None
+    return stats
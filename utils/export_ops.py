@@ -0,0 +1,523 @@
+# utils/export_ops.py
+"""
+Bulk export of requests, work orders and purchase orders for analytics.
+
+Each collection is split into time-range partitions that are streamed in
+parallel straight from Firestore into compressed NDJSON (.ndjson.gz) or
+Parquet files, so memory stays bounded no matter how big the collection is.
+The destination is a local directory or a gs://bucket/prefix URI; GCS
+objects are written through a streaming upload, nothing is staged on disk.
+A partition that fails is deleted rather than left truncated, and
+`_MANIFEST.json` is written to the destination only once every collection
+has been exported, so a run without it is incomplete and must be ignored.
+
+Full runs partition on `created_at`. Incremental runs read everything with
+`updated_at` between the saved watermark and the start of the run. The
+watermarks of all exported collections are saved together, only after every
+file has been written, and trail the run start by a safety margin to cover
+writes stamped just before the run but committed after their partition was
+read (re-exporting a few rows is fine for analytics, losing them is not).
+
+POST /api/export runs the export in a background thread of the serving
+instance. Large backfills should use the CLI (locally or as a Cloud Run job)
+instead, since a serving instance can be recycled mid-run:
+    python -m utils.export_ops --out ./export --format ndjson --incremental
+    python -m utils.export_ops --out gs://my-bucket/exports/today
+"""
+import argparse
+import datetime
+import gzip
+import io
+import json
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from google.cloud import firestore
+from google.cloud import storage
+
+db = firestore.Client()
+gcs = storage.Client()
+REQUEST_COLL = os.getenv("REQUESTS_COLLECTION", "requests")
+WORKORDERS_COLL = os.getenv("WORKORDERS_COLLECTION", "work_orders")
+PO_COLL = os.getenv("PURCHASE_ORDERS_COLLECTION", "purchase_orders")
+EXPORT_STATE_COLL = os.getenv("EXPORT_STATE_COLLECTION", "export_state")
+EXPORT_RUNS_COLL = os.getenv("EXPORT_RUNS_COLLECTION", "export_runs")
+MANIFEST_NAME = "_MANIFEST.json"
+EXPORT_BUCKET = os.getenv("EXPORT_BUCKET")
+
+EXPORT_COLLECTIONS = {
+    "requests": REQUEST_COLL,
+    "work_orders": WORKORDERS_COLL,
+    "purchase_orders": PO_COLL,
+}
+
+# Parquet column types per collection. Values that are missing or do not
+# match their declared type are written as null and kept, as JSON, in the
+# `extra` column together with any field not listed here.
+EXPORT_SCHEMAS = {
+    "requests": [
+        ("requestId", "string"),
+        ("customer_name", "string"),
+        ("phone_number", "string"),
+        ("location", "string"),
+        ("request_type", "string"),
+        ("description", "string"),
+        ("status", "string"),
+        ("workorder_ids", "list<string>"),
+        ("replacement_required", "bool"),
+        ("total_replacements", "int64"),
+        ("purchase_orders_created", "int64"),
+        ("created_at", "timestamp"),
+        ("updated_at", "timestamp"),
+    ],
+    "work_orders": [
+        ("woId", "string"),
+        ("requestId", "string"),
+        ("technician_role", "string"),
+        ("technician_role_name", "string"),
+        ("request_type", "string"),
+        ("status", "string"),
+        ("assigned_to", "string"),
+        ("inspection_file", "string"),
+        ("remark", "string"),
+        ("remark_text", "string"),
+        ("po_created", "bool"),
+        ("po_id", "string"),
+        ("created_at", "timestamp"),
+        ("updated_at", "timestamp"),
+    ],
+    "purchase_orders": [
+        ("poId", "string"),
+        ("requestId", "string"),
+        ("woId", "string"),
+        ("item_name", "string"),
+        ("quantity", "double"),
+        ("price", "double"),
+        ("status", "string"),
+        ("created_at", "timestamp"),
+        ("updated_at", "timestamp"),
+    ],
+}
+
+VALID_FORMATS = ["ndjson", "parquet"]
+DEFAULT_PARTITIONS = int(os.getenv("EXPORT_PARTITIONS", "8"))
+MAX_PARTITIONS = int(os.getenv("EXPORT_MAX_PARTITIONS", "16"))
+WATERMARK_SAFETY = datetime.timedelta(seconds=int(os.getenv("EXPORT_WATERMARK_SAFETY_SECONDS", "300")))
+PARQUET_ROW_GROUP = 5000
+GCS_CHUNK_SIZE = 8 * 1024 * 1024  # upload buffer per open partition file
+
+
+def _now_ts():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _to_json_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, dict):
+        return {k: _to_json_value(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_to_json_value(v) for v in value]
+    return value
+
+
+def _doc_to_row(doc):
+    row = {k: _to_json_value(v) for k, v in doc.to_dict().items()}
+    row["id"] = doc.id
+    return row
+
+
+def _matches(value, kind: str) -> bool:
+    if kind == "string":
+        return isinstance(value, str)
+    if kind == "bool":
+        return isinstance(value, bool)
+    if kind == "int64":
+        return isinstance(value, int) and not isinstance(value, bool)
+    if kind == "double":
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+    if kind == "timestamp":
+        return isinstance(value, datetime.datetime)
+    if kind == "list<string>":
+        return isinstance(value, list) and all(isinstance(v, str) for v in value)
+    return False
+
+
+def _doc_to_typed_row(doc, schema) -> dict:
+    data = doc.to_dict()
+    row = {"id": doc.id}
+    for field, kind in schema:
+        value = data.pop(field, None)
+        if value is None or _matches(value, kind):
+            row[field] = float(value) if kind == "double" and value is not None else value
+        else:
+            row[field] = None
+            data[field] = value
+    row["extra"] = json.dumps(_to_json_value(data), default=str) if data else None
+    return row
+
+
+def _arrow_schema(schema):
+    import pyarrow as pa
+
+    types = {
+        "string": pa.string(),
+        "bool": pa.bool_(),
+        "int64": pa.int64(),
+        "double": pa.float64(),
+        "timestamp": pa.timestamp("us", tz="UTC"),
+        "list<string>": pa.list_(pa.string()),
+    }
+    fields = [pa.field("id", pa.string())]
+    fields += [pa.field(name, types[kind]) for name, kind in schema]
+    fields.append(pa.field("extra", pa.string()))
+    return pa.schema(fields)
+
+
+def _partition_ranges(start, end, partitions: int):
+    """
+    Split [start, end) into `partitions` equal time ranges.
+    """
+    partitions = max(1, partitions)
+    step = (end - start) / partitions
+    bounds = [start + step * i for i in range(partitions)] + [end]
+    return [(bounds[i], bounds[i + 1]) for i in range(partitions) if bounds[i] < bounds[i + 1]]
+
+
+def _earliest(collection: str, field: str):
+    docs = list(
+        db.collection(collection)
+        .order_by(field, direction=firestore.Query.ASCENDING)
+        .limit(1)
+        .stream()
+    )
+    if not docs:
+        return None
+    return docs[0].to_dict().get(field)
+
+
+def get_watermark(name: str):
+    doc = db.collection(EXPORT_STATE_COLL).document(name).get()
+    if not doc.exists:
+        return None
+    return doc.to_dict().get("watermark")
+
+
+def set_watermarks(watermarks: dict) -> None:
+    """
+    Save the watermarks of several collections in one atomic write.
+    """
+    if not watermarks:
+        return
+    batch = db.batch()
+    for name, watermark in watermarks.items():
+        batch.set(db.collection(EXPORT_STATE_COLL).document(name), {
+            "watermark": watermark,
+            "updated_at": _now_ts(),
+        })
+    batch.commit()
+
+
+def _open_output(dest: str, rel_path: str):
+    """
+    Open a binary writable stream for dest/rel_path. gs:// destinations are
+    streamed to GCS in chunks (resumable upload), local ones go to disk.
+    Returns (stream, uri, discard) where discard() deletes the object again.
+    """
+    if dest.startswith("gs://"):
+        bucket_name, _, prefix = dest[len("gs://"):].partition("/")
+        blob_name = f"{prefix.rstrip('/')}/{rel_path}" if prefix else rel_path
+        blob = gcs.bucket(bucket_name).blob(blob_name)
+        # ignore_flush: gzip/pyarrow call flush(), which a resumable upload cannot honour
+        writer = blob.open("wb", chunk_size=GCS_CHUNK_SIZE, ignore_flush=True)
+        return writer, f"gs://{bucket_name}/{blob_name}", blob.delete
+
+    path = os.path.join(dest, rel_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return open(path, "wb"), path, lambda: os.remove(path)
+
+
+def _abandon(closers, discard) -> None:
+    """
+    Clean up after a failed partition: close the streams (a GCS upload only
+    becomes an object once closed) and then delete what was written, so no
+    truncated file that looks complete is left behind.
+    """
+    for close in closers:
+        try:
+            close()
+        except Exception as e:
+            print("export close error:", e)
+    try:
+        discard()
+    except Exception as e:
+        print("export discard error:", e)
+
+
+def _write_ndjson(docs, dest: str, rel_path: str):
+    count = 0
+    raw = f = None
+    uri = discard = None
+    try:
+        for d in docs:
+            # files are only created once there is a row to write
+            if f is None:
+                raw, uri, discard = _open_output(dest, rel_path)
+                f = io.TextIOWrapper(gzip.GzipFile(fileobj=raw, mode="wb"), encoding="utf-8")
+            f.write(json.dumps(_doc_to_row(d), default=str))
+            f.write("\n")
+            count += 1
+    except Exception:
+        if raw is not None:
+            _abandon([f.close, raw.close] if f is not None else [raw.close], discard)
+        raise
+
+    if f is not None:
+        f.close()
+        raw.close()
+    return uri, count
+
+
+def _write_parquet(docs, dest: str, rel_path: str, schema):
+    # pyarrow is only needed for Parquet exports
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    arrow_schema = _arrow_schema(schema)
+    count = 0
+    raw = writer = None
+    uri = discard = None
+    rows = []
+
+    def flush():
+        nonlocal raw, writer, uri, discard
+        if writer is None:
+            raw, uri, discard = _open_output(dest, rel_path)
+            writer = pq.ParquetWriter(raw, arrow_schema, compression="snappy")
+        writer.write_table(pa.Table.from_pylist(rows, schema=arrow_schema))
+        rows.clear()
+
+    try:
+        for d in docs:
+            rows.append(_doc_to_typed_row(d, schema))
+            count += 1
+            if len(rows) >= PARQUET_ROW_GROUP:
+                flush()
+        if rows:
+            flush()
+    except Exception:
+        if raw is not None:
+            _abandon([writer.close, raw.close] if writer is not None else [raw.close], discard)
+        raise
+
+    if writer is not None:
+        writer.close()
+        raw.close()
+    return uri, count
+
+
+def _write_manifest(dest: str, result: dict) -> str:
+    raw, uri, _ = _open_output(dest, MANIFEST_NAME)
+    raw.write(json.dumps(result, indent=2, default=str).encode("utf-8"))
+    raw.close()
+    return uri
+
+
+def _export_partition(name: str, field: str, lo, hi, dest: str, rel_path: str, fmt: str) -> dict:
+    docs = (
+        db.collection(EXPORT_COLLECTIONS[name])
+        .where(field, ">=", lo)
+        .where(field, "<", hi)
+        .stream()
+    )
+
+    if fmt == "parquet":
+        uri, count = _write_parquet(docs, dest, rel_path, EXPORT_SCHEMAS[name])
+    else:
+        uri, count = _write_ndjson(docs, dest, rel_path)
+
+    return {"uri": uri, "rows": count, "from": lo.isoformat(), "to": hi.isoformat()}
+
+
+def export_collection(name: str, dest: str, fmt: str = "ndjson",
+                      partitions: int = DEFAULT_PARTITIONS, incremental: bool = False) -> dict:
+    """
+    Export one collection into `dest/<name>/part-XXXX.<ext>`.
+    Returns a manifest with the written files and row counts. For
+    incremental runs manifest["watermark"] is the value to save once the
+    whole export succeeded (None when it should stay unchanged); this
+    function never saves it itself.
+    """
+    collection = EXPORT_COLLECTIONS[name]
+    run_started = _now_ts()
+
+    if incremental:
+        field = "updated_at"
+        start = get_watermark(name) or _earliest(collection, field)
+    else:
+        field = "created_at"
+        start = _earliest(collection, field)
+
+    manifest = {"collection": name, "field": field, "files": [], "rows": 0, "watermark": None}
+
+    if start is None or start >= run_started:
+        return manifest
+
+    ext = "parquet" if fmt == "parquet" else "ndjson.gz"
+    ranges = _partition_ranges(start, run_started, partitions)
+    with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+        futures = [
+            pool.submit(
+                _export_partition, name, field, lo, hi,
+                dest, f"{name}/part-{i:04d}.{ext}", fmt,
+            )
+            for i, (lo, hi) in enumerate(ranges)
+        ]
+        # .result() re-raises, so a failed partition fails the whole export
+        parts = [f.result() for f in futures]
+
+    manifest["files"] = [p["uri"] for p in parts if p["uri"]]
+    manifest["rows"] = sum(p["rows"] for p in parts)
+
+    if incremental:
+        # trail the run start so late-committed writes are picked up next run;
+        # never move an existing watermark backwards
+        manifest["watermark"] = max(start, run_started - WATERMARK_SAFETY)
+
+    return manifest
+
+
+def validate_export_args(collections=None, fmt: str = "ndjson",
+                         partitions: int = DEFAULT_PARTITIONS):
+    """
+    Return an error message for bad export arguments, or None.
+    """
+    unknown = [c for c in (collections or []) if c not in EXPORT_COLLECTIONS]
+    if unknown:
+        return f"Unknown collections: {', '.join(unknown)}"
+
+    if fmt not in VALID_FORMATS:
+        return f"format must be one of {', '.join(VALID_FORMATS)}"
+
+    if not isinstance(partitions, int) or isinstance(partitions, bool) \
+            or not 1 <= partitions <= MAX_PARTITIONS:
+        return f"partitions must be an integer between 1 and {MAX_PARTITIONS}"
+
+    return None
+
+
+def run_export(dest: str, collections=None, fmt: str = "ndjson",
+               partitions: int = DEFAULT_PARTITIONS, incremental: bool = False) -> dict:
+    """
+    Export the requested collections (all three by default) to `dest`, a
+    local directory or a gs://bucket/prefix URI.
+    Returns {"collections": [...manifests]} or {"error": ...}.
+    """
+    try:
+        error = validate_export_args(collections, fmt, partitions)
+        if error:
+            return {"error": error}
+
+        collections = collections or list(EXPORT_COLLECTIONS)
+
+        manifests = [
+            export_collection(c, dest, fmt, partitions, incremental)
+            for c in collections
+        ]
+
+        result = {
+            "dest": dest,
+            "format": fmt,
+            "incremental": incremental,
+            "finished_at": _now_ts().isoformat(),
+            "collections": manifests,
+        }
+
+        # every file is written at this point: mark the run complete, then
+        # let the watermarks move (a crash in between only re-exports rows)
+        result["manifest"] = _write_manifest(dest, result)
+
+        if incremental:
+            set_watermarks({
+                m["collection"]: m["watermark"]
+                for m in manifests if m["watermark"] is not None
+            })
+
+        for m in manifests:
+            if m["watermark"] is not None:
+                m["watermark"] = m["watermark"].isoformat()
+
+        return result
+
+    except Exception as e:
+        print("run_export error:", e)
+        return {"error": str(e)}
+
+
+_export_lock = threading.Lock()
+
+
+def start_export_run(dest_root: str, collections=None, fmt: str = "ndjson",
+                     partitions: int = DEFAULT_PARTITIONS, incremental: bool = False):
+    """
+    Start run_export in a background thread writing to dest_root/<run_id>.
+    Progress is kept in the export_runs collection (see get_export_run).
+    Returns the run_id, or None if this instance is already exporting.
+    """
+    if not _export_lock.acquire(blocking=False):
+        return None
+
+    run_id = datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%SZ") + "-" + uuid.uuid4().hex[:6]
+    dest = f"{dest_root.rstrip('/')}/{run_id}"
+    run_ref = db.collection(EXPORT_RUNS_COLL).document(run_id)
+
+    try:
+        run_ref.set({
+            "runId": run_id,
+            "dest": dest,
+            "status": "RUNNING",
+            "created_at": _now_ts(),
+            "updated_at": _now_ts(),
+        })
+    except Exception:
+        _export_lock.release()
+        raise
+
+    def _run():
+        try:
+            result = run_export(dest, collections, fmt, partitions, incremental)
+            run_ref.update({
+                "status": "FAILED" if "error" in result else "SUCCEEDED",
+                "result": result,
+                "updated_at": _now_ts(),
+            })
+        except Exception as e:
+            print("export run error:", e)
+        finally:
+            _export_lock.release()
+
+    threading.Thread(target=_run, name=f"export-{run_id}", daemon=True).start()
+    return run_id
+
+
+def get_export_run(run_id: str):
+    doc = db.collection(EXPORT_RUNS_COLL).document(run_id).get()
+    if not doc.exists:
+        return None
+    return doc.to_dict()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk export Firestore collections")
+    parser.add_argument("--out", required=True, help="output directory or gs://bucket/prefix")
+    parser.add_argument("--format", default="ndjson", choices=VALID_FORMATS)
+    parser.add_argument("--partitions", type=int, default=DEFAULT_PARTITIONS)
+    parser.add_argument("--collections", nargs="*", choices=list(EXPORT_COLLECTIONS))
+    parser.add_argument("--incremental", action="store_true",
+                        help="export only documents updated since the saved watermark")
+    args = parser.parse_args()
+
+    result = run_export(args.out, args.collections, args.format, args.partitions, args.incremental)
+    print(json.dumps(result, indent=2))
@@ -4,7 +4,8 @@ import uuid
 import datetime
 import os
 
-from utils.pubsub_ops import publish_request_event,publish_po_event
+from utils.outbox_ops import enqueue_event, REQUEST_TOPIC, PO_TOPIC
+from utils.idempotency_ops import get_cached_response, run_idempotent
 
 db = firestore.Client()
 REQUEST_COLL = os.getenv("REQUESTS_COLLECTION", "requests")
@@ -19,13 +20,16 @@ TECH_ROLES = [
 def _now_ts():
     return datetime.datetime.now(datetime.timezone.utc)
 
-def create_work_orders(request_id: str, request_type: str, created_by: str = None):
+def create_work_orders(request_id: str, request_type: str, created_by: str = None, batch=None):
     """
     Create 3 work_orders documents (U,P,T) for the request and return list of woIds.
     Each work order will include request_type copied from request document.
+    If a batch is passed, the writes are added to it and the caller commits.
     """
     wo_ids = []
-    batch = db.batch()
+    own_batch = batch is None
+    if own_batch:
+        batch = db.batch()
     for r in TECH_ROLES:
         wo_id = f"WO-{uuid.uuid4().hex[:12]}"
         doc_ref = db.collection(WORKORDERS_COLL).document(wo_id)
@@ -48,16 +52,22 @@ def create_work_orders(request_id: str, request_type: str, created_by: str = Non
         batch.set(doc_ref, payload)
         wo_ids.append(wo_id)
     # commit the batch to create all work orders atomically
-    batch.commit()
+    if own_batch:
+        batch.commit()
     return wo_ids
 
-def create_request(data: dict) -> dict:
+def create_request(data: dict, idempotency_key: str = None) -> dict:
     """
     Create a request document and 3 work orders.
     Expected input data keys: customer_name, phone_number, location, request_type, description (optional)
+    With an idempotency_key, a retry returns the first response without writing again.
     Returns the created request document info.
     """
     try:
+        cached = get_cached_response("create_request", idempotency_key, data)
+        if cached is not None:
+            return cached
+
         # validate minimal fields
         customer_name = data.get("customer_name") or data.get("name")
         phone = data.get("phone_number") or data.get("phone")
@@ -68,50 +78,58 @@ def create_request(data: dict) -> dict:
         if not customer_name or not phone or not location:
             return {"error": "customer_name, phone_number and location are required"}
 
-        request_id = f"SN-{uuid.uuid4().hex[:10]}"
-        request_doc = db.collection(REQUEST_COLL).document(request_id)
-        now = _now_ts()
-        request_payload = {
-            "requestId": request_id,
-            "customer_name": customer_name,
-            "phone_number": phone,
-            "location": location,
-            "request_type": request_type,
-            "description": description,
-            "status": "CRT",  # created
-            "workorder_ids": [],
-            "created_at": now,
-            "updated_at": now,
-        }
-
-        # create request doc
-        request_doc.set(request_payload)
-
-        # create work orders and attach ids to request
-        wo_ids = create_work_orders(request_id, request_type)
-        request_doc.update({"workorder_ids": wo_ids, "updated_at": _now_ts()})
+        def _write(writer):
+            return _write_request(writer, customer_name, phone, location, request_type, description)
 
-        # publish request event to Pub/Sub for analytics (best-effort)
-        event_payload = {
-            "event": "REQUEST_CREATED",
-            "requestId": request_id,
-            "customer_name": customer_name,
-            "phone_number": phone,
-            "location": location,
-            "request_type": request_type,
-            "workorder_ids": wo_ids,
-            "created_at": now.isoformat() + "Z",
-            "source": "cloudrun-backend"
-        }
-        publish_request_event(event_payload)
-
-        # return created object
-        result = {"requestId": request_id, **request_payload, "workorder_ids": wo_ids}
+        result, _ = run_idempotent("create_request", idempotency_key, data, _write)
         return result
 
     except Exception as e:
         print("create_request error:", e)
         return {"error": str(e)}
+
+def _write_request(writer, customer_name, phone, location, request_type, description) -> dict:
+    """
+    Add the request, its work orders and the REQUEST_CREATED outbox event to writer.
+    """
+    request_id = f"SN-{uuid.uuid4().hex[:10]}"
+    request_doc = db.collection(REQUEST_COLL).document(request_id)
+    now = _now_ts()
+    request_payload = {
+        "requestId": request_id,
+        "customer_name": customer_name,
+        "phone_number": phone,
+        "location": location,
+        "request_type": request_type,
+        "description": description,
+        "status": "CRT",  # created
+        "workorder_ids": [],
+        "created_at": now,
+        "updated_at": now,
+    }
+
+    # request doc, work orders and outbox event are committed together
+    wo_ids = create_work_orders(request_id, request_type, batch=writer)
+    request_payload["workorder_ids"] = wo_ids
+    writer.set(request_doc, request_payload)
+
+    # request event for analytics, published later by the outbox drainer
+    event_payload = {
+        "event": "REQUEST_CREATED",
+        "requestId": request_id,
+        "customer_name": customer_name,
+        "phone_number": phone,
+        "location": location,
+        "request_type": request_type,
+        "workorder_ids": wo_ids,
+        "created_at": now.isoformat() + "Z",
+        "source": "cloudrun-backend"
+    }
+    enqueue_event(writer, REQUEST_TOPIC, event_payload)
+
+    # return created object
+    result = {"requestId": request_id, **request_payload, "workorder_ids": wo_ids}
+    return result
 def update_work_order_status(wo_id: str, status: str) -> dict:
     """
     Update a work order status (IN-PROGRESS, GOOD, REPLACE),
@@ -204,12 +222,17 @@ def update_work_order_status(wo_id: str, status: str) -> dict:
         print("update_work_order_status error:", e)
         return {"error": str(e)}
 
-def create_purchase_order(data: dict) -> dict:
+def create_purchase_order(data: dict, idempotency_key: str = None) -> dict:
     """
     Create a purchase order ONLY after inspection is completed
     and replacement is required.
+    With an idempotency_key, a retry returns the first response without writing again.
     """
     try:
+        cached = get_cached_response("create_purchase_order", idempotency_key, data)
+        if cached is not None:
+            return cached
+
         request_id = data.get("requestId")
         wo_id = data.get("woId")
         item = data.get("item_name")
@@ -219,82 +242,78 @@ def create_purchase_order(data: dict) -> dict:
         if not request_id or not wo_id or not item:
             return {"error": "requestId, woId and item_name are required"}
 
-        # 🔍 Fetch request
         req_ref = db.collection(REQUEST_COLL).document(request_id)
-        req_doc = req_ref.get()
+        wo_ref = db.collection(WORKORDERS_COLL).document(wo_id)
 
-        if not req_doc.exists:
-            return {"error": "Request not found"}
+        def _write(transaction):
+            # checks read inside the transaction, so two concurrent calls
+            # cannot both create a PO for the same work order
 
-        req_data = req_doc.to_dict()
+            # 🔍 Fetch request
+            req_doc = req_ref.get(transaction=transaction)
 
-        # ✅ Allow PO only after inspection completed
-        if req_data.get("status") != "INSPECTION_COMPLETED":
-            return {"error": "Inspection not completed yet"}
+            if not req_doc.exists:
+                return {"error": "Request not found"}
 
-        # ✅ Allow PO only if replacement is required
-        if not req_data.get("replacement_required", False):
-            return {"error": "Replacement not required for this request"}
+            req_data = req_doc.to_dict()
 
-        # 🔍 Fetch work order
-        wo_ref = db.collection(WORKORDERS_COLL).document(wo_id)
-        wo_doc = wo_ref.get()
+            # ✅ Allow PO only after inspection completed
+            if req_data.get("status") != "INSPECTION_COMPLETED":
+                return {"error": "Inspection not completed yet"}
 
-        if not wo_doc.exists:
-            return {"error": "Work order not found"}
+            # ✅ Allow PO only if replacement is required
+            if not req_data.get("replacement_required", False):
+                return {"error": "Replacement not required for this request"}
 
-        wo_data = wo_doc.to_dict()
+            # 🔍 Fetch work order
+            wo_doc = wo_ref.get(transaction=transaction)
 
-        if wo_data.get("po_created"):
-            return {"error": "Purchase order already created for this work order"}
+            if not wo_doc.exists:
+                return {"error": "Work order not found"}
 
-        po_id = f"PO-{uuid.uuid4().hex[:12]}"
-        now = _now_ts()
+            wo_data = wo_doc.to_dict()
 
-        # 1️⃣ Create PO document
-        po_payload = {
-            "poId": po_id,
-            "requestId": request_id,
-            "woId": wo_id,
-            "item_name": item,
-            "quantity": qty,
-            "price": price,
-            "status": "CREATED",
-            "created_at": now,
-            "updated_at": now,
-        }
-
-        db.collection("purchase_orders").document(po_id).set(po_payload)
-
-        # 2️⃣ Update work order
-        wo_ref.update({
-            "po_created": True,
-            "po_id": po_id,
-            "updated_at": now,
-        })
+            if wo_data.get("po_created"):
+                return {"error": "Purchase order already created for this work order"}
 
-        # 3️⃣ Update request → ORDERED (ONLY HERE ✅)
-        # 3️⃣ Increment PO count
-        req_ref = db.collection(REQUEST_COLL).document(request_id)
+            po_id = f"PO-{uuid.uuid4().hex[:12]}"
+            now = _now_ts()
 
-        req_ref.update({
-            "purchase_orders_created": firestore.Increment(1),
-            "updated_at": now,
-        })
+            # 1️⃣ Create PO document
+            po_payload = {
+                "poId": po_id,
+                "requestId": request_id,
+                "woId": wo_id,
+                "item_name": item,
+                "quantity": qty,
+                "price": price,
+                "status": "CREATED",
+                "created_at": now,
+                "updated_at": now,
+            }
 
-        # 4️⃣ Check if all POs are created
-        req_doc = req_ref.get().to_dict()
+            # PO, work order, request and outbox event are committed together
+            transaction.set(db.collection("purchase_orders").document(po_id), po_payload)
 
-        if req_doc.get("purchase_orders_created", 0) >= req_doc.get("total_replacements", 0):
-            req_ref.update({
-                "status": "ORDERED",
+            # 2️⃣ Update work order
+            transaction.update(wo_ref, {
+                "po_created": True,
+                "po_id": po_id,
                 "updated_at": now,
             })
 
+            # 3️⃣ Increment PO count, request → ORDERED once all POs are created (ONLY HERE ✅)
+            po_count = req_data.get("purchase_orders_created", 0) + 1
+            req_updates = {
+                "purchase_orders_created": po_count,
+                "updated_at": now,
+            }
+            if po_count >= req_data.get("total_replacements", 0):
+                req_updates["status"] = "ORDERED"
+            transaction.update(req_ref, req_updates)
 
-        # 4️⃣ Publish PO event
-        try:
-            publish_po_event({
+            # 4️⃣ PO event, published later by the outbox drainer
+            enqueue_event(transaction, PO_TOPIC, {
                 "event": "PO_CREATED",
                 "poId": po_id,
                 "requestId": request_id,
@@ -304,13 +323,14 @@ def create_purchase_order(data: dict) -> dict:
                 "price": price,
                 "created_at": now.isoformat() + "Z",
             })
-        except Exception as e:
-            print("PO PubSub publish failed:", e)
 
-        return {
-            "message": "Purchase order created successfully",
-            "poId": po_id
-        }
+            return {
+                "message": "Purchase order created successfully",
+                "poId": po_id
+            }
+
+        result, _ = run_idempotent("create_purchase_order", idempotency_key, data, _write)
+        return result
 
     except Exception as e:
         print("create_purchase_order error:", e)
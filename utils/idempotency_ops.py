@@ -0,0 +1,98 @@
+# utils/idempotency_ops.py
+"""
+Idempotency-Key support for write endpoints.
+
+The key record is read and written in the same Firestore transaction as the
+domain writes, so a retried request either sees the committed response of
+the first attempt or performs the write itself - never both.
+
+Records carry an `expires_at` field; enable a Firestore TTL policy on it for
+the idempotency collection so old keys are cleaned up automatically.
+"""
+import datetime
+import hashlib
+import json
+import os
+
+from google.cloud import firestore
+
+db = firestore.Client()
+IDEMPOTENCY_COLL = os.getenv("IDEMPOTENCY_COLLECTION", "idempotency_keys")
+IDEMPOTENCY_TTL_HOURS = int(os.getenv("IDEMPOTENCY_TTL_HOURS", "24"))
+
+
+def _now_ts():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _key_ref(scope: str, key: str):
+    # keys are client supplied, so hash them into a safe document id
+    doc_id = hashlib.sha256(f"{scope}:{key}".encode("utf-8")).hexdigest()
+    return db.collection(IDEMPOTENCY_COLL).document(doc_id)
+
+
+def _fingerprint(data: dict) -> str:
+    return hashlib.sha256(
+        json.dumps(data, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def _cached_response(snap, fingerprint: str):
+    if not snap.exists:
+        return None
+    record = snap.to_dict()
+    if not record.get("expires_at") or record["expires_at"] <= _now_ts():
+        return None
+    if record.get("fingerprint") != fingerprint:
+        # routes turn this flag into a 422 so clients can tell it from success
+        return {
+            "error": "Idempotency-Key was already used with a different payload",
+            "idempotency_conflict": True,
+        }
+    return record["response"]
+
+
+def get_cached_response(scope: str, key: str, data: dict):
+    """
+    Single-read fast path for retries: return the stored response for this
+    key, or None if the request has not been processed yet.
+    """
+    if not key:
+        return None
+    return _cached_response(_key_ref(scope, key).get(), _fingerprint(data))
+
+
+def run_idempotent(scope: str, key: str, data: dict, write_fn):
+    """
+    Run `write_fn(transaction)` in a Firestore transaction and commit it.
+
+    `write_fn` may read with `ref.get(transaction=transaction)` (reads must
+    come before its writes), adds its writes to the transaction and returns
+    the response dict. It can be called more than once if the transaction
+    is retried. Responses with an "error" key are not cached.
+
+    Returns (response, replayed).
+    """
+    key_ref = _key_ref(scope, key) if key else None
+    fingerprint = _fingerprint(data)
+
+    @firestore.transactional
+    def _txn(transaction):
+        if key_ref is not None:
+            cached = _cached_response(key_ref.get(transaction=transaction), fingerprint)
+            if cached is not None:
+                return cached, True
+
+        response = write_fn(transaction)
+        if key_ref is not None and "error" not in response:
+            now = _now_ts()
+            transaction.set(key_ref, {
+                "scope": scope,
+                "fingerprint": fingerprint,
+                "response": response,
+                "created_at": now,
+                "expires_at": now + datetime.timedelta(hours=IDEMPOTENCY_TTL_HOURS),
+            })
+        return response, False
+
+    return _txn(db.transaction())
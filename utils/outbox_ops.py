@@ -0,0 +1,205 @@
+# utils/outbox_ops.py
+"""
+Transactional outbox for domain events.
+
+Write paths call `enqueue_event` with the same Firestore batch/transaction
+as the domain write, so an event exists if and only if the write committed.
+`drain_outbox` later claims pending entries, publishes them to Pub/Sub in
+large batches and deletes the ones that were delivered.
+
+Claiming sets status IN_FLIGHT, a `lease_until` and a per-drain
+`claimed_by` token in a transaction, so drainers in different
+workers/instances never publish the same entries at the same time. The
+publish wait is bounded well inside the lease, and results are written
+back in a transaction that skips entries whose token changed (another
+drainer reclaimed them after the lease expired). Entries whose drainer
+died are picked up again once their lease expires; delivery is therefore
+at-least-once, and consumers can dedupe on the `eventId` message attribute.
+
+Required composite indexes (see firestore.indexes.json):
+  (status ASC, created_at ASC) and (status ASC, lease_until ASC)
+"""
+import datetime
+import os
+import threading
+import time
+import uuid
+
+from google.cloud import firestore
+
+from utils.pubsub_ops import publish_batch
+
+db = firestore.Client()
+OUTBOX_COLL = os.getenv("OUTBOX_COLLECTION", "event_outbox")
+REQUEST_TOPIC = os.getenv("REQUEST_TOPIC", "request-events")
+PO_TOPIC = os.getenv("PO_TOPIC", "po-events")
+
+DRAIN_BATCH_SIZE = int(os.getenv("OUTBOX_DRAIN_BATCH_SIZE", "500"))
+DRAIN_INTERVAL = float(os.getenv("OUTBOX_DRAIN_INTERVAL", "2"))
+MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "20"))
+LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", "120"))
+# total wait for one publish batch; keep it well inside the lease so the
+# results can be written back while the claim is still ours
+PUBLISH_TIMEOUT = min(float(os.getenv("OUTBOX_PUBLISH_TIMEOUT", "30")), LEASE_SECONDS / 3)
+
+_drain_lock = threading.Lock()
+_drainer_thread = None
+
+
+def _now_ts():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def enqueue_event(writer, topic: str, payload: dict) -> str:
+    """
+    Add an outbox entry to `writer` (a WriteBatch or Transaction).
+    Nothing is written until the caller commits.
+    Returns the eventId.
+    """
+    event_id = f"EV-{uuid.uuid4().hex}"
+    writer.set(db.collection(OUTBOX_COLL).document(event_id), {
+        "eventId": event_id,
+        "topic": topic,
+        "payload": payload,
+        "status": "PENDING",
+        "attempts": 0,
+        "created_at": _now_ts(),
+    })
+    return event_id
+
+
+def _claimable(entry: dict, now) -> bool:
+    if entry.get("status") == "PENDING":
+        return True
+    return entry.get("status") == "IN_FLIGHT" and entry.get("lease_until") is not None \
+        and entry["lease_until"] <= now
+
+
+def _claim_entries(limit: int, token: str) -> list:
+    """
+    Atomically mark up to `limit` PENDING (or lease-expired IN_FLIGHT)
+    entries as IN_FLIGHT, claimed by `token`. Returns [(reference, entry)].
+    """
+    now = _now_ts()
+    expired = list(
+        db.collection(OUTBOX_COLL)
+        .where("status", "==", "IN_FLIGHT")
+        .where("lease_until", "<=", now)
+        .limit(limit)
+        .stream()
+    )
+    pending = list(
+        db.collection(OUTBOX_COLL)
+        .where("status", "==", "PENDING")
+        .order_by("created_at", direction=firestore.Query.ASCENDING)
+        .limit(max(0, limit - len(expired)))
+        .stream()
+    ) if len(expired) < limit else []
+
+    refs = [d.reference for d in expired + pending]
+    if not refs:
+        return []
+
+    @firestore.transactional
+    def _txn(transaction):
+        claimed = []
+        lease_until = _now_ts() + datetime.timedelta(seconds=LEASE_SECONDS)
+        # re-read inside the transaction: another drainer may have won the race
+        for snap in db.get_all(refs, transaction=transaction):
+            if not snap.exists:
+                continue
+            entry = snap.to_dict()
+            if not _claimable(entry, _now_ts()):
+                continue
+            transaction.update(snap.reference, {
+                "status": "IN_FLIGHT",
+                "lease_until": lease_until,
+                "claimed_by": token,
+            })
+            claimed.append((snap.reference, entry))
+        return claimed
+
+    return _txn(db.transaction())
+
+
+def _finish_entries(claimed: list, results: list, token: str) -> dict:
+    """
+    Delete delivered entries and release failed ones, but only those still
+    claimed by `token`; the rest belong to whichever drainer reclaimed them.
+    """
+    outcome = {ref.path: (entry, ok) for (ref, entry), ok in zip(claimed, results)}
+
+    @firestore.transactional
+    def _txn(transaction):
+        counts = {"published": 0, "failed": 0, "lost_claim": 0}
+        snaps = list(db.get_all([ref for ref, _ in claimed], transaction=transaction))
+        for snap in snaps:
+            entry, ok = outcome[snap.reference.path]
+            if not snap.exists or snap.to_dict().get("claimed_by") != token:
+                counts["lost_claim"] += 1
+                continue
+            if ok:
+                transaction.delete(snap.reference)
+                counts["published"] += 1
+            else:
+                attempts = entry.get("attempts", 0) + 1
+                transaction.update(snap.reference, {
+                    "attempts": attempts,
+                    "status": "FAILED" if attempts >= MAX_ATTEMPTS else "PENDING",
+                    "lease_until": None,
+                    "claimed_by": None,
+                    "updated_at": _now_ts(),
+                })
+                counts["failed"] += 1
+        return counts
+
+    return _txn(db.transaction())
+
+
+def drain_outbox(limit: int = DRAIN_BATCH_SIZE) -> dict:
+    """
+    Claim up to `limit` outbox entries, publish them and delete the delivered ones.
+    Failed entries go back to PENDING with their attempt count bumped; after
+    MAX_ATTEMPTS they are marked FAILED so they stop blocking the queue.
+    """
+    if not _drain_lock.acquire(blocking=False):
+        return {"published": 0, "failed": 0, "skipped": True}
+
+    try:
+        token = uuid.uuid4().hex
+        claimed = _claim_entries(limit, token)
+        if not claimed:
+            return {"published": 0, "failed": 0}
+
+        results = publish_batch([
+            (e["topic"], e["payload"], {"eventId": e["eventId"]})
+            for _, e in claimed
+        ], timeout=PUBLISH_TIMEOUT)
+
+        return _finish_entries(claimed, results, token)
+
+    except Exception as e:
+        print("drain_outbox error:", e)
+        return {"error": str(e)}
+
+    finally:
+        _drain_lock.release()
+
+
+def _drain_forever():
+    while True:
+        result = drain_outbox()
+        # keep going straight away while there is a backlog
+        if result.get("published", 0) < DRAIN_BATCH_SIZE:
+            time.sleep(DRAIN_INTERVAL)
+
+
+def start_outbox_drainer():
+    """
+    Start the background drainer thread once per process.
+    """
+    global _drainer_thread
+    if _drainer_thread is not None and _drainer_thread.is_alive():
+        return
+    _drainer_thread = threading.Thread(target=_drain_forever, name="outbox-drainer", daemon=True)
+    _drainer_thread.start()
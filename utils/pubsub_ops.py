@@ -1,42 +1,44 @@
 # utils/pubsub_ops.py
 import os
 import json
+from concurrent import futures as cf
 from google.cloud import pubsub_v1
 
 PROJECT_ID = os.getenv("PROJECT_ID")  # e.g. bigquerypractise-475707
-REQUEST_TOPIC = os.getenv("REQUEST_TOPIC", "request-events")  # topic name
-publisher = pubsub_v1.PublisherClient()
-# topic path: projects/{project_id}/topics/{topic}
-def _topic_path(topic_name: str):
-    return publisher.topic_path(PROJECT_ID, topic_name)
 
-def publish_request_event(payload: dict) -> bool:
-    """
-    Publish the given payload (dict) to the request-events topic.
-    Returns True on success.
-    """
-    try:
-        topic_path = _topic_path(REQUEST_TOPIC)
-        data = json.dumps(payload).encode("utf-8")
-        # attributes optional, not used here
-        future = publisher.publish(topic_path, data)
-        future.result(timeout=10)  # raise if publish failed
-        return True
-    except Exception as e:
-        # In production you would log properly
-        print("publish_request_event error:", e)
-        return False
+# Batched publisher used by the outbox drainer: many messages per RPC
+batch_publisher = pubsub_v1.PublisherClient(
+    batch_settings=pubsub_v1.types.BatchSettings(
+        max_messages=int(os.getenv("PUBSUB_BATCH_MAX_MESSAGES", "500")),
+        max_bytes=1024 * 1024,
+        max_latency=0.05,
+    )
+)
 
-def publish_po_event(payload: dict) -> bool:
+def publish_batch(messages: list, timeout: float = 30) -> list:
     """
-    Same pattern for PO events if needed later.
+    Publish a list of (topic_name, payload, attributes) tuples in as few
+    Pub/Sub requests as possible, waiting at most `timeout` seconds in total.
+    Returns a list of booleans, one per message, True on success; messages
+    not confirmed by the deadline count as failed.
     """
-    try:
-        topic_path = _topic_path(os.getenv("PO_TOPIC", "po-events"))
+    futures = []
+    for topic_name, payload, attributes in messages:
+        # topic path: projects/{project_id}/topics/{topic}
+        topic_path = batch_publisher.topic_path(PROJECT_ID, topic_name)
         data = json.dumps(payload).encode("utf-8")
-        future = publisher.publish(topic_path, data)
-        future.result(timeout=10)
-        return True
-    except Exception as e:
-        print("publish_po_event error:", e)
-        return False
+        futures.append(batch_publisher.publish(topic_path, data, **(attributes or {})))
+
+    # one deadline for the whole batch, not one per message
+    cf.wait(futures, timeout=timeout)
+
+    results = []
+    for future in futures:
+        if not future.done():
+            results.append(False)
+        elif future.exception() is not None:
+            print("publish_batch error:", future.exception())
+            results.append(False)
+        else:
+            results.append(True)
+    return results